@@ -0,0 +1,26 @@
+# gunicorn -c gunicorn_conf.py main:app
+#
+# Dev-сервер Flask однопоточный и блокируется на каждом Bybit-вызове;
+# gthread-воркеры обрабатывают всплеск алертов параллельно, preload
+# шарит session/кэши между воркерами через COW.
+
+import os
+
+bind = "0.0.0.0:" + os.getenv("PORT", "5000")
+# Один воркер: дедуп/идемпотентность/очередь сигналов живут в памяти
+# процесса — второй воркер пропускал бы ретрай TV мимо них (дубль-ордер).
+# I/O-параллелизм дают 8 gthread-тредов. Больше воркеров — только после
+# выноса дедупа во внешний стор.
+workers = int(os.getenv("WEB_WORKERS", "1"))
+threads = int(os.getenv("WEB_THREADS", "8"))
+worker_class = "gthread"
+preload_app = True
+keepalive = 30
+
+
+def post_fork(server, worker):
+    # Треды, запущенные на импорте в мастере, не переживают fork —
+    # каждый воркер поднимает свой комплект здесь.
+    from main import start_background_threads
+
+    start_background_threads()
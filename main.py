@@ -1,14 +1,56 @@
 import os
+import fcntl
+import hashlib
+import hmac
+import pickle
+import queue
+import socket
 import time
 import logging
-import traceback
+import logging.handlers
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import decimal
 from decimal import Decimal, ROUND_DOWN
-
-from flask import Flask, request, jsonify
+from functools import lru_cache
+
+# Цены/количества Bybit — максимум ~8 знаков, всё квантуется к tick/step;
+# дефолтные 28 digits у Decimal — лишняя работа на каждый умнож./деление.
+# DefaultContext правим до старта тредов: новые треды наследуют именно его.
+decimal.DefaultContext.prec = 12
+decimal.setcontext(decimal.DefaultContext)
+
+import orjson
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from pybit.unified_trading import HTTP
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class _OrjsonProvider(JSONProvider):
+    """
+    jsonify/request JSON через orjson (в разы быстрее stdlib json).
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+app.json = _OrjsonProvider(app)
+
+# Логи через очередь: запись в stdout (line-buffered pipe на Render)
+# уходит в фоновый тред и не блокирует обработку запроса.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
 
 # =======================
 # ENV (Render -> Environment)
@@ -56,19 +98,390 @@ TRAIL_DELAY_SEC = int(os.getenv("TRAIL_DELAY_SEC", "20"))
 
 AUTO_REVERSE = os.getenv("AUTO_REVERSE", "true").lower() == "true"
 
+# Ордеры через WebSocket trade API (долгоживущий сокет, без HTTP-запроса
+# на каждый ордер). По умолчанию выключено — включать после проверки на тестнете.
+USE_WS_TRADING = os.getenv("USE_WS_TRADING", "false").lower() == "true"
+WS_ORDER_ACK_TIMEOUT_SEC = float(os.getenv("WS_ORDER_ACK_TIMEOUT_SEC", "5"))
+
+# Зеркала position/ticker из WS-стримов: get_position/get_bid_ask читают
+# из памяти вместо REST, пока снапшот свежий. Тоже opt-in.
+USE_WS_STREAMS = os.getenv("USE_WS_STREAMS", "false").lower() == "true"
+WS_SNAPSHOT_MAX_AGE_SEC = float(os.getenv("WS_SNAPSHOT_MAX_AGE_SEC", "2"))
+
+# Дедуп повторных алертов TV (ретраи шлют тот же сигнал несколько раз)
+DEDUP_WINDOW_SEC = int(os.getenv("DEDUP_WINDOW_SEC", "10"))
+
+# Период пинга, держащего keep-alive соединение тёплым
+KEEPALIVE_PING_SEC = int(os.getenv("KEEPALIVE_PING_SEC", "30"))
+
+# Событие старше этого возраста (поле "ts" от TV) не торгуем
+MAX_EVENT_AGE_SEC = int(os.getenv("MAX_EVENT_AGE_SEC", "30"))
+
+# Таймаут REST-вызовов к Bybit: повисший запрос не должен держать
+# воркера бесконечно
+BYBIT_TIMEOUT_SEC = int(os.getenv("BYBIT_TIMEOUT_SEC", "5"))
+
 # Bybit session (Unified Trading)
 session = HTTP(
     testnet=BYBIT_TESTNET,
     api_key=BYBIT_API_KEY,
     api_secret=BYBIT_API_SECRET,
+    timeout=BYBIT_TIMEOUT_SEC,
 )
 
-# Кэш фильтров инструмента
-_instrument_cache = {}  # symbol -> dict(filters..., ts)
-CACHE_TTL = 60 * 10  # 10 минут
+# Keep-alive пул на внутренней requests.Session pybit:
+# без него каждый вызов платит TCP+TLS handshake (~150ms) к api.bybit.com.
+class _KeepAliveAdapter(HTTPAdapter):
+    """
+    TCP_NODELAY: мелкие signed-запросы уходят сразу, без Nagle.
+    SO_KEEPALIVE: соединение в пуле не умирает молча за NAT.
+    """
+
+    _SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self._SOCKET_OPTIONS
+        return super().init_poolmanager(*args, **kwargs)
+
+
+_adapter = _KeepAliveAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+)
+session.client.mount("https://", _adapter)
+session.client.headers["Connection"] = "keep-alive"
+
+
+# Локальный лимитер перед Bybit: бурст алертов не должен выбивать 429 —
+# бэкофф после него дороже, чем подождать пару мс в окне.
+RATE_LIMIT_GET_PER_SEC = int(os.getenv("RATE_LIMIT_GET_PER_SEC", "20"))
+RATE_LIMIT_POST_PER_SEC = int(os.getenv("RATE_LIMIT_POST_PER_SEC", "10"))
+
+
+class _SlidingWindowLimiter:
+    def __init__(self, max_calls: int, window_sec: float = 1.0):
+        self.max_calls = max_calls
+        self.window_sec = window_sec
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] > self.window_sec:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait = self.window_sec - (now - self._calls[0])
+            time.sleep(max(wait, 0.005))
+
+
+# Ордерные (POST) методы квотируются отдельно от чтений
+_POST_METHODS = {
+    "place_order",
+    "place_batch_order",
+    "set_trading_stop",
+    "cancel_all_orders",
+    "set_leverage",
+}
+
+
+class _ThrottledSession:
+    """
+    Прокси над pybit HTTP: каждый вызов проходит скользящее окно
+    (GET и POST — раздельные бакеты). Остальные атрибуты прозрачны.
+    """
+
+    def __init__(self, http):
+        self._http = http
+        self._get = _SlidingWindowLimiter(RATE_LIMIT_GET_PER_SEC)
+        self._post = _SlidingWindowLimiter(RATE_LIMIT_POST_PER_SEC)
+
+    def __getattr__(self, name):
+        attr = getattr(self._http, name)
+        if not callable(attr):
+            return attr
+        limiter = self._post if name in _POST_METHODS else self._get
+
+        def _call(*args, **kwargs):
+            limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return _call
+
+
+session = _ThrottledSession(session)
+
+# Пул потоков для параллельных preflight-вызовов (leverage/ticker/filters
+# не зависят друг от друга -> latency = max(RTT), а не sum(RTT)).
+_executor = ThreadPoolExecutor(max_workers=4)
+
+# Долгоживущий WS trade-коннект (опционально, см. USE_WS_TRADING)
+_ws_trading = None
+if USE_WS_TRADING:
+    try:
+        from pybit.unified_trading import WebSocketTrading
+
+        _ws_trading = WebSocketTrading(
+            testnet=BYBIT_TESTNET,
+            api_key=BYBIT_API_KEY,
+            api_secret=BYBIT_API_SECRET,
+        )
+    except Exception as _e:
+        logging.info("WS trading unavailable -> HTTP fallback: %s", str(_e))
+        _ws_trading = None
+
+
+def _place_order(**kwargs):
+    """
+    Единая точка отправки ордеров: WS trade API, если включён и жив,
+    иначе обычный HTTP place_order. Формат ответа одинаковый (retCode и т.д.).
+    """
+    if _ws_trading is not None:
+        try:
+            return _ws_place_order(**kwargs)
+        except Exception as e:
+            logging.info("WS place_order failed -> HTTP fallback: %s", str(e))
+    return session.place_order(**kwargs)
+
+
+def _ws_place_order(**kwargs):
+    """
+    pybit WS trade API отвечает в callback; ждём ACK с таймаутом,
+    чтобы семантика осталась синхронной, как у HTTP.
+    """
+    holder = {}
+    done = threading.Event()
+
+    def _cb(message):
+        holder["resp"] = message
+        done.set()
+
+    _ws_trading.place_order(_cb, **kwargs)
+    if not done.wait(WS_ORDER_ACK_TIMEOUT_SEC):
+        raise RuntimeError("WS place_order ACK timeout")
+    return holder["resp"]
+
+
+# Живые снапшоты из WS-стримов: symbol -> (mono_ts, payload)
+_live_positions = {}
+_live_tickers = {}
+_live_lock = threading.Lock()
+
+# На какие тикеры уже подписаны (universe расширяется лениво)
+_ws_ticker_subs = set()
+
+
+def _ws_subscribe_ticker(symbol: str):
+    """
+    Ленивая подписка на тикер символа, которого не было в прогреве:
+    первый вебхук по нему платит REST, дальше идёт из WS-снапшота.
+    """
+    ws_public = globals().get("_ws_public")
+    if ws_public is None or symbol in _ws_ticker_subs:
+        return
+    try:
+        ws_public.ticker_stream(symbol=symbol, callback=_on_ws_ticker)
+        _ws_ticker_subs.add(symbol)
+        logging.info("WS ticker subscribed: %s", symbol)
+    except Exception as e:
+        logging.info("WS ticker subscribe failed %s: %s", symbol, str(e))
+
+
+def _on_ws_position(message):
+    try:
+        for p in message.get("data") or []:
+            symbol = p.get("symbol")
+            if not symbol:
+                continue
+            size = Decimal(str(p.get("size") or "0"))
+            pos = None
+            if abs(size) > 0:
+                pos = {
+                    "side": str(p.get("side") or ""),
+                    "size": size,
+                    "avgPrice": Decimal(str(p.get("avgPrice") or "0")),
+                }
+            with _live_lock:
+                _live_positions[symbol] = (_mono(), pos)
+            # Событийный менеджер: push по позиции приходит сразу после
+            # исполнения TP1 — не ждём следующего вебхука, чтобы
+            # переставить SL в BE / включить трейлинг.
+            with _state_lock:
+                tracked = symbol in _position_state
+            if tracked:
+                _submit_manager_tick(symbol)
+    except Exception as e:
+        logging.info("WS position parse error: %s", str(e))
+
+
+# Свой пул для тиков менеджера: их бэклог не должен отбирать треды у
+# preflight-фьючер place_entry в общем _executor
+_manager_executor = ThreadPoolExecutor(max_workers=4)
+_mgr_inflight = set()
+_mgr_inflight_lock = threading.Lock()
+
+# Пер-символьные локи: тик менеджера и мутации state из process_signal
+# (reverse-pop, manage_after_entry) не должны перекрываться — иначе тик,
+# прочитавший старый st до реверса, запишет его обратно поверх нового.
+_symbol_locks: dict[str, threading.Lock] = {}
+_symbol_locks_lock = threading.Lock()
+
+
+def _symbol_lock(symbol: str) -> threading.Lock:
+    with _symbol_locks_lock:
+        lk = _symbol_locks.get(symbol)
+        if lk is None:
+            lk = _symbol_locks[symbol] = threading.Lock()
+        return lk
+
+
+def _submit_manager_tick(symbol: str):
+    """
+    Тик делает несколько REST-вызовов (каждый с таймаутом) — пока он не
+    закончился, повторный тик того же символа пропускается: _state_lock
+    защищает только map, а не read-modify-write всего тика.
+    """
+    with _mgr_inflight_lock:
+        if symbol in _mgr_inflight:
+            return
+        _mgr_inflight.add(symbol)
+    _manager_executor.submit(_manager_tick, symbol)
+
+
+def _manager_tick(symbol: str):
+    try:
+        with _symbol_lock(symbol):
+            update_position_manager(symbol)
+    except Exception as e:
+        logging.info("update_position_manager skipped: %s", str(e))
+    finally:
+        with _mgr_inflight_lock:
+            _mgr_inflight.discard(symbol)
+
+
+def _on_ws_ticker(message):
+    try:
+        d = message.get("data") or {}
+        symbol = d.get("symbol")
+        if not symbol:
+            return
+        with _live_lock:
+            _, prev = _live_tickers.get(symbol, (0.0, (None, None, None)))
+        # ticker-стрим шлёт дельты — отсутствующие поля берём из прошлого снапшота
+        last = d.get("lastPrice") or prev[0]
+        bid = d.get("bid1Price") or prev[1] or last
+        ask = d.get("ask1Price") or prev[2] or last
+        if last is None:
+            return
+        snap = (Decimal(str(last)), Decimal(str(bid)), Decimal(str(ask)))
+        with _live_lock:
+            _live_tickers[symbol] = (_mono(), snap)
+    except Exception as e:
+        logging.info("WS ticker parse error: %s", str(e))
+
+
+def _ws_fresh(store: dict, symbol: str):
+    """
+    (found, value): found=True только если снапшот моложе WS_SNAPSHOT_MAX_AGE_SEC.
+    """
+    with _live_lock:
+        entry = store.get(symbol)
+    if entry is None:
+        return False, None
+    ts, value = entry
+    if _mono() - ts > WS_SNAPSHOT_MAX_AGE_SEC:
+        return False, None
+    return True, value
+
+
+def _start_ws_streams():
+    try:
+        from pybit.unified_trading import WebSocket
+
+        ws_private = WebSocket(
+            channel_type="private",
+            testnet=BYBIT_TESTNET,
+            api_key=BYBIT_API_KEY,
+            api_secret=BYBIT_API_SECRET,
+        )
+        ws_private.position_stream(callback=_on_ws_position)
+
+        ws_public = WebSocket(channel_type="linear", testnet=BYBIT_TESTNET)
+        for sym in [DEFAULT_SYMBOL] + PREWARM_SYMBOLS:
+            ws_public.ticker_stream(symbol=sym, callback=_on_ws_ticker)
+            _ws_ticker_subs.add(sym)
+
+        # держим ссылки, чтобы коннекты не собрал GC
+        globals()["_ws_private"] = ws_private
+        globals()["_ws_public"] = ws_public
+        logging.info("WS streams up: position + tickers %s", [DEFAULT_SYMBOL] + PREWARM_SYMBOLS)
+    except Exception as e:
+        logging.info("WS streams unavailable -> REST only: %s", str(e))
+
+# Кэш фильтров инструмента (lotSize/tick меняются крайне редко)
+CACHE_TTL = 60 * 60 * 6  # 6 часов
+_instrument_cache = TTLCache(maxsize=256, ttl=CACHE_TTL)  # symbol -> (qty_step, tick_size)
+_instrument_lock = threading.Lock()
+
+# Файл-копия кэша фильтров: переживает рестарты/редеплои,
+# чтобы первый трейд после деплоя не платил RTT за фильтры.
+INSTRUMENT_CACHE_FILE = os.getenv("INSTRUMENT_CACHE_FILE", "/tmp/instr_cache.pkl")
+
+# Доп. символы для прогрева на старте (через запятую)
+PREWARM_SYMBOLS = [s.strip() for s in os.getenv("PREWARM_SYMBOLS", "").upper().split(",") if s.strip()]
 
-# Состояние менеджера позиций (TP1->BE->Trailing)
-_position_state = {}  # symbol -> dict(state)
+# Состояние менеджера позиций (TP1->BE->Trailing).
+# LRU вместо dict: сиротские записи (позиция закрылась без нового
+# вебхука) не копятся бесконечно на долгоживущем инстансе.
+_position_state = LRUCache(maxsize=1024)  # symbol -> dict(state)
+_state_lock = threading.RLock()  # webhook-треды и worker трогают state одновременно
+
+# Свип сирот: state старше часа без апдейтов проверяем раз в 5 минут
+STATE_SWEEP_SEC = 300
+STATE_STALE_SEC = 3600
+
+# Период фонового прохода менеджера по отслеживаемым позициям
+MANAGER_POLL_SEC = float(os.getenv("MANAGER_POLL_SEC", "2"))
+
+# Файл-копия state менеджера: BE/trailing по открытой позиции не должны
+# теряться на редеплое. Пишет фоновый тред и только если были изменения.
+STATE_FILE = os.getenv("STATE_FILE", "/tmp/position_state.pkl")
+STATE_FLUSH_SEC = 2
+_state_dirty = threading.Event()
+
+# Дедуп сигналов: (symbol, side) -> True, живёт DEDUP_WINDOW_SEC
+_dedup_cache = TTLCache(maxsize=1024, ttl=DEDUP_WINDOW_SEC)
+_dedup_lock = threading.Lock()
+
+# Ответ на дубликат заранее сериализован — на этом пути ни одного dumps
+_DUP_RESP_BODY = orjson.dumps({"ok": True, "msg": "Duplicate signal -> skip", "skipped": True})
+
+# Идемпотентность: event_id (или hash тела) -> True, на случай ретраев TV
+_seen_events = TTLCache(maxsize=4096, ttl=600)
+_seen_lock = threading.Lock()
+
+# Последнее применённое плечо: symbol -> leverage. Именно последнее, а не
+# множество виденных пар: при 5x -> 10x -> 5x третий вызов обязан уйти в
+# REST, иначе биржа остаётся на 10x при размере под 5x.
+# Плечо между алертами почти не меняется -> экономим RTT на каждом webhook.
+_lev_applied = TTLCache(maxsize=64, ttl=3600)
+_lev_lock = threading.Lock()
+
+# ATR внутри 1m-бара не меняется: (symbol, len, mult, минута) -> dist
+_atr_cache = TTLCache(maxsize=256, ttl=120)
+_atr_lock = threading.Lock()
+
+# Секундный снапшот тикера: параллельные вызовы одного сигнала
+# делят один REST-фетч, staleness <=1s на фоне latency алерта незаметна
+_ticker_cache = TTLCache(maxsize=256, ttl=1)
+_ticker_lock = threading.Lock()
 
 
 def ok(msg, **extra):
@@ -87,14 +500,76 @@ def _now() -> int:
     return int(time.time())
 
 
+def _mono() -> float:
+    """
+    Монотонные часы для внутренних таймеров (trailing delay):
+    NTP-скачки time.time() не ломают отсчёт.
+    """
+    return time.monotonic()
+
+
+# Константы Decimal один раз, а не на каждый расчёт
+_D1 = Decimal("1")
+_D100 = Decimal("100")
+_D90PCT = Decimal("0.90")  # допуск на частичное исполнение TP1
+_MAX_SPREAD_D = Decimal(str(MAX_SPREAD_PCT))
+# Буфер комиссии для BE как доля: 0.10% -> 0.0010
+_FEE_BUF = Decimal(str(BYBIT_TAKER_FEE_PCT)) / _D100 / _D100
+
+
+@lru_cache(maxsize=64)
+def _pct_to_dec(pct: float) -> Decimal:
+    """
+    0.55 (%) -> Decimal("0.0055"). Процентов в конфиге немного,
+    lru_cache убирает Decimal(str(...))/100 с горячего пути.
+    """
+    return Decimal(str(pct)) / _D100
+
+
+@lru_cache(maxsize=256)
+def _num_to_dec(x) -> Decimal:
+    """
+    Кэш конвертации usd/leverage: набор значений от TV маленький,
+    а Decimal(str(...)) — самая дорогая операция Decimal.
+    """
+    return Decimal(str(x))
+
+
+# Single-flight на холодный miss: параллельные вебхуки одного нового
+# символа делят один REST-фетч, а не дублируют его
+_instrument_inflight = {}  # symbol -> Future
+
+
 def get_instrument_filters(symbol: str):
     """
     Возвращает qtyStep и tickSize как Decimal для корректного округления.
+    На хите REST-вызова нет вообще; на miss'е конкуренты ждут один фетч.
     """
-    cached = _instrument_cache.get(symbol)
-    if cached and (_now() - cached["ts"] < CACHE_TTL):
-        return cached["qty_step"], cached["tick_size"]
+    key = hashkey(symbol)
+    with _instrument_lock:
+        if key in _instrument_cache:
+            return _instrument_cache[key]
+        fut = _instrument_inflight.get(symbol)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _instrument_inflight[symbol] = fut
+    if not owner:
+        return fut.result()
+    try:
+        val = _fetch_instrument_filters(symbol)
+        fut.set_result(val)
+        return val
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _instrument_lock:
+            _instrument_inflight.pop(symbol, None)
+
 
+@cached(_instrument_cache, lock=_instrument_lock)
+def _fetch_instrument_filters(symbol: str):
     r = session.get_instruments_info(category="linear", symbol=symbol)
     if r.get("retCode") != 0:
         raise RuntimeError(f"Bybit get_instruments_info error: {r}")
@@ -109,25 +584,195 @@ def get_instrument_filters(symbol: str):
 
     qty_step = Decimal(str(lot.get("qtyStep", "0.1")))
     tick_size = Decimal(str(pf.get("tickSize", "0.0001")))
-
-    _instrument_cache[symbol] = {
-        "qty_step": qty_step,
-        "tick_size": tick_size,
-        "ts": _now(),
-    }
+    _save_instrument_filters(symbol, (qty_step, tick_size))
     return qty_step, tick_size
 
 
+def _save_instrument_filters(symbol: str, value):
+    """
+    Write-through на диск (best-effort): пара Decimal на символ, редкие miss'ы.
+    """
+    try:
+        data = {}
+        try:
+            with open(INSTRUMENT_CACHE_FILE, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            pass
+        data[symbol] = value
+        tmp = INSTRUMENT_CACHE_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f)
+        os.replace(tmp, INSTRUMENT_CACHE_FILE)
+    except Exception as e:
+        logging.info("Instrument cache dump failed: %s", str(e))
+
+
+def _load_instrument_cache():
+    """
+    Сидируем кэш с диска до первого webhook (после рестарта).
+    """
+    try:
+        with open(INSTRUMENT_CACHE_FILE, "rb") as f:
+            data = pickle.load(f)
+        for sym, val in data.items():
+            _instrument_cache[hashkey(sym)] = val
+        logging.info("Instrument cache loaded from disk: %d symbols", len(data))
+    except Exception:
+        pass
+
+
+def _prewarm_instruments():
+    """
+    Прогрев на старте: DNS + TLS handshake и кэш фильтров, чтобы первый
+    webhook после деплоя не платил холодные 200-400ms.
+    """
+    _load_instrument_cache()
+    try:
+        session.get_server_time()  # дешёвый публичный вызов, греет соединение
+        for sym in [DEFAULT_SYMBOL] + PREWARM_SYMBOLS:
+            get_instrument_filters(sym)
+    except Exception as e:
+        logging.info("Instrument prefetch skipped: %s", str(e))
+
+
+def _keepalive_loop():
+    """
+    Фоновый пинг каждые KEEPALIVE_PING_SEC: иначе idle-сокет в пуле
+    закрывается сервером/NAT и следующий ордер снова платит handshake.
+    """
+    while True:
+        time.sleep(KEEPALIVE_PING_SEC)
+        try:
+            session.get_server_time()
+        except Exception as e:
+            logging.info("Keep-alive ping failed: %s", str(e))
+
+
+def _sweep_states():
+    """
+    Выкидывает из _position_state сирот: записи без апдейтов больше часа,
+    по которым позиции на бирже уже нет. get_positions зовём только для
+    протухших записей, не на каждый проход.
+    """
+    while True:
+        time.sleep(STATE_SWEEP_SEC)
+        now = _mono()
+        with _state_lock:
+            stale = [s for s, st in _position_state.items()
+                     if now - float(st.get("last_ts", now)) > STATE_STALE_SEC]
+        for symbol in stale:
+            try:
+                if get_position(symbol) is None:
+                    with _state_lock:
+                        _position_state.pop(symbol, None)
+                    _state_dirty.set()
+                    logging.info("State sweep: dropped orphan %s", symbol)
+            except Exception as e:
+                logging.info("State sweep skipped %s: %s", symbol, str(e))
+
+
+def _manager_loop():
+    """
+    Фоновая сверка TP1/BE/trailing: без неё менеджер зависел от прихода
+    вебхуков — затишье в сигналах оставляло позицию без BE после TP1.
+    WS-пуши (chunk3-4) дают мгновенную реакцию, этот цикл — страховка
+    и таймер трейлинга.
+    """
+    while True:
+        time.sleep(MANAGER_POLL_SEC)
+        with _state_lock:
+            symbols = list(_position_state.keys())
+        for symbol in symbols:
+            _submit_manager_tick(symbol)
+
+
+def _flush_states():
+    """
+    Скидывает state на диск не чаще раза в STATE_FLUSH_SEC и только после
+    реальных изменений (best-effort, как кэш фильтров).
+    Писатель один: при WEB_WORKERS>1 файл получает первый захвативший
+    flock, иначе воркеры перетирали бы state друг друга (last-writer-wins).
+    """
+    try:
+        lock_f = open(STATE_FILE + ".lock", "a+b")
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        logging.info("State flush disabled: another worker holds the lock")
+        return
+    while True:
+        _state_dirty.wait()
+        time.sleep(STATE_FLUSH_SEC)  # коалесцируем всплеск апдейтов в одну запись
+        _state_dirty.clear()
+        with _state_lock:
+            snap = dict(_position_state.items())
+        try:
+            tmp = STATE_FILE + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(snap, f)
+            os.replace(tmp, STATE_FILE)
+        except Exception as e:
+            logging.info("State dump failed: %s", str(e))
+
+
+def _load_states():
+    """
+    Восстановление state после рестарта, до первого webhook.
+    """
+    try:
+        with open(STATE_FILE, "rb") as f:
+            data = pickle.load(f)
+    except Exception:
+        return
+    now = _mono()
+    with _state_lock:
+        for sym, st in data.items():
+            # Монотонные метки прошлого процесса бессмысленны — ребейзим;
+            # trailing-делей у живой позиции к рестарту обычно уже отслужил.
+            st["last_ts"] = now
+            st["trail_enable_at"] = now
+            _position_state[sym] = st
+    if data:
+        logging.info("Position state restored: %d symbols", len(data))
+
+
+@lru_cache(maxsize=256)
+def _step_quantizer(step: Decimal):
+    """
+    Для степеней десяти (0.001, 0.0001 — обычные шаги Bybit) возвращает
+    квантайзер для value.quantize(...); иначе None (шаги вроде 0.5).
+    """
+    t = step.as_tuple()
+    if t.sign == 0 and t.digits == (1,):
+        return Decimal(1).scaleb(t.exponent)
+    return None
+
+
 def round_down_to_step(value: Decimal, step: Decimal) -> Decimal:
     """
-    Округление вниз к кратности step: floor(value/step)*step
+    Округление вниз к кратности step.
+    Шаг-степень-десяти: один quantize. Иначе floor-div + умножение.
     """
     if step <= 0:
         return value
-    return (value / step).quantize(Decimal("1"), rounding=ROUND_DOWN) * step
+    q = _step_quantizer(step)
+    if q is not None:
+        return value.quantize(q, rounding=ROUND_DOWN)
+    return (value // step) * step
 
 
 def get_bid_ask(symbol: str):
+    if USE_WS_STREAMS:
+        found, snap = _ws_fresh(_live_tickers, symbol)
+        if found:
+            return snap
+        _ws_subscribe_ticker(symbol)  # новый символ -> следующий раз без REST
+
+    with _ticker_lock:
+        snap = _ticker_cache.get(symbol)
+    if snap is not None:
+        return snap
+
     r = session.get_tickers(category="linear", symbol=symbol)
     if r.get("retCode") != 0:
         raise RuntimeError(f"Bybit get_tickers error: {r}")
@@ -138,13 +783,22 @@ def get_bid_ask(symbol: str):
     last = Decimal(str(item.get("lastPrice")))
     bid = Decimal(str(item.get("bid1Price") or item.get("lastPrice")))
     ask = Decimal(str(item.get("ask1Price") or item.get("lastPrice")))
-    return last, bid, ask
+
+    snap = (last, bid, ask)
+    with _ticker_lock:
+        _ticker_cache[symbol] = snap
+    return snap
 
 
 def set_leverage(symbol: str, leverage: int):
     """
     110043 = leverage not modified (это НЕ ошибка).
+    Пока плечо символа не меняется от последнего применённого,
+    повторные вызовы не ходят в REST вообще.
     """
+    with _lev_lock:
+        if _lev_applied.get(symbol) == leverage:
+            return
     try:
         r = session.set_leverage(
             category="linear",
@@ -158,21 +812,34 @@ def set_leverage(symbol: str, leverage: int):
         msg = str(e)
         if ("110043" in msg) or ("leverage not modified" in msg.lower()):
             logging.info("Leverage already set (110043) -> ignore")
+            with _lev_lock:
+                _lev_applied[symbol] = leverage
             return
         raise
+    with _lev_lock:
+        _lev_applied[symbol] = leverage
 
 
 def get_position(symbol: str):
     """
     Возвращает позицию или None.
     """
+    if USE_WS_STREAMS:
+        found, pos = _ws_fresh(_live_positions, symbol)
+        if found:
+            return pos
+
     r = session.get_positions(category="linear", symbol=symbol)
     if r.get("retCode") != 0:
         raise RuntimeError(f"Bybit get_positions error: {r}")
 
     pos_list = (r.get("result") or {}).get("list") or []
     for p in pos_list:
-        size = Decimal(str(p.get("size") or "0"))
+        raw_size = p.get("size")
+        # Частый случай — позиции нет: "0"/"" отсекаем без Decimal-парсинга
+        if not raw_size or raw_size == "0":
+            continue
+        size = Decimal(str(raw_size))
         if abs(size) > 0:
             return {
                 "side": str(p.get("side") or ""),      # "Buy"/"Sell"
@@ -186,16 +853,16 @@ def cancel_all_orders(symbol: str):
     session.cancel_all_orders(category="linear", symbol=symbol)
 
 
+# Неизменная часть аргументов set_trading_stop
+_TRADING_STOP_TEMPLATE = {"category": "linear", "tpslMode": "Full"}
+
+
 def set_trading_stop(symbol: str, tp_price: Decimal | None, sl_price: Decimal | None, trailing_dist: Decimal | None = None):
     """
     Управление стопами на позиции (SL/TP/Trailing) — надежнее, чем пытаться “склеить” в place_order.
     trailing_dist = абсолютная дистанция в цене.
     """
-    args = {
-        "category": "linear",
-        "symbol": symbol,
-        "tpslMode": "Full",
-    }
+    args = dict(_TRADING_STOP_TEMPLATE, symbol=symbol)
     if tp_price is not None:
         args["takeProfit"] = str(tp_price)
     if sl_price is not None:
@@ -203,31 +870,55 @@ def set_trading_stop(symbol: str, tp_price: Decimal | None, sl_price: Decimal |
     if trailing_dist is not None and trailing_dist > 0:
         args["trailingStop"] = str(trailing_dist)
 
+    # Все None -> менять нечего, REST-вызов был бы пустым
+    if len(args) == len(_TRADING_STOP_TEMPLATE) + 1:
+        return {"retCode": 0, "retMsg": "noop"}
+
     r = session.set_trading_stop(**args)
     if r.get("retCode") != 0:
         raise RuntimeError(f"Bybit set_trading_stop error: {r}")
     return r
 
 
+# Противоположная сторона (закрытие/реверс)
+_OPP_SIDE = {"Buy": "Sell", "Sell": "Buy"}
+
+# Знак смещения цены: для Buy профит выше входа, для Sell — ниже.
+_PCT_SIGN = {
+    ("Buy", "tp"): 1,
+    ("Buy", "sl"): -1,
+    ("Sell", "tp"): -1,
+    ("Sell", "sl"): 1,
+}
+
+
+@lru_cache(maxsize=256)
+def _pct_factor(side: str, pct: float, direction: str) -> Decimal:
+    return _D1 + _PCT_SIGN[(side, direction)] * _pct_to_dec(pct)
+
+
 def price_by_pct(entry_price: Decimal, side: str, pct: float, tick_size: Decimal, direction: str):
     """
     direction:
       - "tp": в сторону прибыли
       - "sl": в сторону убытка
     """
-    p = Decimal(str(pct)) / Decimal("100")
-    if side == "Buy":
-        price = entry_price * (Decimal("1") + p) if direction == "tp" else entry_price * (Decimal("1") - p)
-    else:
-        price = entry_price * (Decimal("1") - p) if direction == "tp" else entry_price * (Decimal("1") + p)
-    return round_down_to_step(price, tick_size)
+    return round_down_to_step(entry_price * _pct_factor(side, pct, direction), tick_size)
 
 
 def compute_atr_distance(symbol: str, tick_size: Decimal, atr_len: int, atr_mult: float) -> Decimal:
     """
     ATR Wilder по 1m kline (Bybit).
     Возвращает trailing дистанцию (в цене).
+    Кэш по минутному бару: без него каждый вызов — это get_kline
+    (самый тяжёлый REST-ответ на этом пути).
     """
+    key = (symbol, atr_len, atr_mult, int(time.time() // 60))
+    with _atr_lock:
+        cached_dist = _atr_cache.get(key)
+    if cached_dist is not None:
+        return cached_dist
+
     try:
         r = session.get_kline(category="linear", symbol=symbol, interval="1", limit=atr_len + 2)
         if r.get("retCode") != 0:
@@ -236,11 +927,13 @@ def compute_atr_distance(symbol: str, tick_size: Decimal, atr_len: int, atr_mult
         if len(kl) < atr_len:
             return tick_size
 
+        # Вся математика во float: Decimal здесь в ~100x дороже,
+        # а результат всё равно квантуется к tick_size.
         highs, lows, closes = [], [], []
         for row in reversed(kl):
-            highs.append(Decimal(str(row[2])))
-            lows.append(Decimal(str(row[3])))
-            closes.append(Decimal(str(row[4])))
+            highs.append(float(row[2]))
+            lows.append(float(row[3]))
+            closes.append(float(row[4]))
 
         trs = []
         for i in range(1, len(closes)):
@@ -256,11 +949,13 @@ def compute_atr_distance(symbol: str, tick_size: Decimal, atr_len: int, atr_mult
         # Wilder smoothing
         atr = trs[0]
         for tr in trs[1:]:
-            atr = (atr * Decimal(str(atr_len - 1)) + tr) / Decimal(str(atr_len))
+            atr = (atr * (atr_len - 1) + tr) / atr_len
 
-        dist = atr * Decimal(str(atr_mult))
-        dist = round_down_to_step(dist, tick_size)
-        return dist if dist > 0 else tick_size
+        dist = round_down_to_step(Decimal(str(atr * atr_mult)), tick_size)
+        dist = dist if dist > 0 else tick_size
+        with _atr_lock:
+            _atr_cache[key] = dist
+        return dist
     except Exception as e:
         logging.info("ATR calc fallback: %s", str(e))
         return tick_size
@@ -271,8 +966,8 @@ def place_tp1_reduce_only(symbol: str, pos_side: str, qty: Decimal, price: Decim
     TP1 лимиткой reduceOnly.
     pos_side = "Buy"/"Sell" (сторона позиции)
     """
-    close_side = "Sell" if pos_side == "Buy" else "Buy"
-    r = session.place_order(
+    close_side = _OPP_SIDE[pos_side]
+    r = _place_order(
         category="linear",
         symbol=symbol,
         side=close_side,
@@ -287,32 +982,26 @@ def place_tp1_reduce_only(symbol: str, pos_side: str, qty: Decimal, price: Decim
     return r
 
 
-def close_position_market(symbol: str, pos_side: str, qty: Decimal):
+def _close_order_args(symbol: str, pos_side: str, qty: Decimal) -> dict:
     """
-    Закрыть позицию по рынку reduceOnly.
+    Аргументы market-close reduceOnly (без category — чтобы годились
+    и для одиночного ордера, и для элемента batch-запроса).
     """
-    close_side = "Sell" if pos_side == "Buy" else "Buy"
-    r = session.place_order(
-        category="linear",
-        symbol=symbol,
-        side=close_side,
-        orderType="Market",
-        qty=str(qty),
-        timeInForce="IOC",
-        reduceOnly=True,
-    )
-    if r.get("retCode") != 0:
-        raise RuntimeError(f"Bybit close position error: {r}")
-    return r
+    close_side = _OPP_SIDE[pos_side]
+    return {
+        "symbol": symbol,
+        "side": close_side,
+        "orderType": "Market",
+        "qty": str(qty),
+        "timeInForce": "IOC",
+        "reduceOnly": True,
+    }
 
 
-def manage_after_entry(symbol: str, side: str, entry_price: Decimal, qty: Decimal, tick_size: Decimal, qty_step: Decimal, impulse: bool):
+def build_protection_plan(side: str, entry_price: Decimal, qty: Decimal, tick_size: Decimal, qty_step: Decimal):
     """
-    Ставим:
-      - TP1 reduceOnly (50%)
-      - Early SL (на всю позицию)
-      - базовый TP/SL можно оставить через set_trading_stop (если хочешь)
-      - записываем state для BE + trailing
+    Считает TP1/early SL/размеры заранее, чтобы их можно было
+    прикрепить прямо к входному ордеру (один REST вместо трёх).
     """
     if side == "Buy":
         tp1_pct = LONG_TP1_PCT
@@ -332,51 +1021,86 @@ def manage_after_entry(symbol: str, side: str, entry_price: Decimal, qty: Decima
     if tp1_qty <= 0:
         tp1_qty = qty
 
-    # TP1 reduceOnly
-    place_tp1_reduce_only(symbol, side, tp1_qty, tp1_price)
+    return {
+        "tp1_price": tp1_price,
+        "early_sl": early_sl,
+        "tp1_qty": tp1_qty,
+        "be_offset": be_offset,
+        "atr_mult": atr_mult,
+    }
 
-    # Early SL на всю позицию
-    set_trading_stop(symbol, tp_price=None, sl_price=early_sl, trailing_dist=None)
 
-    _position_state[symbol] = {
-        "side": side,
-        "entry": str(entry_price),
-        "qty": str(qty),
-        "tp1_qty": str(tp1_qty),
-        "tp1_price": str(tp1_price),
-        "tp1_hit": False,
-        "be_set": False,
-        "trail_enabled": False,
-        "trail_enable_at": _now() + int(TRAIL_DELAY_SEC),
-        "atr_mult": str(atr_mult),
-        "be_offset": str(be_offset),
-        "impulse": bool(impulse),
-        "last_ts": _now(),
-    }
+def manage_after_entry(symbol: str, side: str, entry_price: Decimal, qty: Decimal, tick_size: Decimal, qty_step: Decimal, impulse: bool, plan=None, attached: bool = False):
+    """
+    Ставим (если не прикреплены к входному ордеру):
+      - TP1 reduceOnly (50%)
+      - Early SL (на всю позицию)
+    и записываем state для BE + trailing.
+    """
+    if plan is None:
+        plan = build_protection_plan(side, entry_price, qty, tick_size, qty_step)
+
+    tp1_price = plan["tp1_price"]
+    early_sl = plan["early_sl"]
+    tp1_qty = plan["tp1_qty"]
+    be_offset = plan["be_offset"]
+    atr_mult = plan["atr_mult"]
+
+    if not attached:
+        # TP1 reduceOnly
+        place_tp1_reduce_only(symbol, side, tp1_qty, tp1_price)
+
+        # Early SL на всю позицию
+        set_trading_stop(symbol, tp_price=None, sl_price=early_sl, trailing_dist=None)
+
+    now = _mono()  # один срез часов на весь state
+    with _state_lock:
+        _position_state[symbol] = {
+            "side": side,
+            "entry": str(entry_price),
+            "qty": str(qty),
+            "tp1_qty": str(tp1_qty),
+            "tp1_price": str(tp1_price),
+            "tp1_hit": False,
+            "be_set": False,
+            "trail_enabled": False,
+            "trail_enable_at": now + int(TRAIL_DELAY_SEC),
+            "atr_mult": str(atr_mult),
+            "be_offset": str(be_offset),
+            "impulse": bool(impulse),
+            "qty_step": str(qty_step),
+            "tick_size": str(tick_size),
+            "last_ts": now,
+        }
+    _state_dirty.set()
 
     return {
         "tp1_price": str(tp1_price),
         "tp1_qty": str(tp1_qty),
         "early_sl": str(early_sl),
-        "trail_enable_at": int(_position_state[symbol]["trail_enable_at"]),
+        "trail_in_sec": int(TRAIL_DELAY_SEC),
     }
 
 
 def update_position_manager(symbol: str):
     """
-    Вызывается при каждом webhook.
+    Тик менеджера: зовётся из _manager_loop и по WS-событию позиции,
+    всегда под _symbol_lock(symbol).
     Делает:
       - detect TP1 by size shrink
       - SL -> BE
       - trailing after delay and after TP1
     """
-    st = _position_state.get(symbol)
+    with _state_lock:
+        st = _position_state.get(symbol)
     if not st:
         return
 
     pos = get_position(symbol)
     if not pos:
-        _position_state.pop(symbol, None)
+        with _state_lock:
+            _position_state.pop(symbol, None)
+        _state_dirty.set()
         return
 
     side = st["side"]
@@ -384,11 +1108,19 @@ def update_position_manager(symbol: str):
     qty_initial = Decimal(st["qty"])
     tp1_qty = Decimal(st["tp1_qty"])
 
-    qty_step, tick_size = get_instrument_filters(symbol)
+    # Фильтры записаны в state при входе; поход в кэш — только для
+    # state, переживших старый формат.
+    if "tick_size" in st:
+        qty_step = Decimal(st["qty_step"])
+        tick_size = Decimal(st["tick_size"])
+    else:
+        qty_step, tick_size = get_instrument_filters(symbol)
+
     size_now = abs(pos["size"])
+    now = _mono()
 
     # TP1 “считаем исполненным”, если размер уменьшился примерно на TP1
-    if (not st["tp1_hit"]) and (size_now <= (qty_initial - (tp1_qty * Decimal("0.90")))):
+    if (not st["tp1_hit"]) and (size_now <= (qty_initial - (tp1_qty * _D90PCT))):
         st["tp1_hit"] = True
         logging.info("TP1 assumed hit for %s (size_now=%s)", symbol, str(size_now))
 
@@ -396,65 +1128,128 @@ def update_position_manager(symbol: str):
         cancel_all_orders(symbol)
 
         # BE = entry + offset + fee_buffer (в сторону прибыли)
-        be_offset = Decimal(st["be_offset"]) / Decimal("100")
-        fee_buffer = Decimal(str(BYBIT_TAKER_FEE_PCT)) / Decimal("100") / Decimal("100")  # 0.10% -> 0.0010
-        total_pct = (be_offset + fee_buffer) * Decimal("100")  # обратно в %
+        be_offset = Decimal(st["be_offset"]) / _D100
+        total_pct = (be_offset + _FEE_BUF) * _D100  # обратно в %
 
         be_price = price_by_pct(entry, side, float(total_pct), tick_size, "tp")
         set_trading_stop(symbol, tp_price=None, sl_price=be_price, trailing_dist=None)
         st["be_set"] = True
 
     # trailing только после TP1 и после таймера
-    if st["tp1_hit"] and (not st["trail_enabled"]) and (_now() >= int(st["trail_enable_at"])):
+    if st["tp1_hit"] and (not st["trail_enabled"]) and (now >= float(st["trail_enable_at"])):
         atr_mult = float(st["atr_mult"])
         dist = compute_atr_distance(symbol, tick_size, ATR_LEN, atr_mult)
         set_trading_stop(symbol, tp_price=None, sl_price=None, trailing_dist=dist)
         st["trail_enabled"] = True
         logging.info("ATR trailing enabled for %s dist=%s", symbol, str(dist))
 
-    st["last_ts"] = _now()
-    _position_state[symbol] = st
+    st["last_ts"] = now
+    with _state_lock:
+        _position_state[symbol] = st
+    _state_dirty.set()
 
 
-def calc_qty_from_usd(symbol: str, usd: float, leverage: int, price: Decimal) -> Decimal:
-    qty_step, _ = get_instrument_filters(symbol)
-    notional = Decimal(str(usd)) * Decimal(str(leverage))
+def calc_qty_from_usd(usd: float, leverage: int, price: Decimal, qty_step: Decimal) -> Decimal:
+    """
+    qty_step приходит от вызывающего — place_entry уже держит фильтры,
+    второй поход в get_instrument_filters здесь был лишним.
+    """
+    notional = _num_to_dec(usd) * _num_to_dec(leverage)
     raw_qty = notional / price
     qty = round_down_to_step(raw_qty, qty_step)
     return qty
 
 
-def place_entry(symbol: str, side: str, usd: float, leverage: int, impulse: bool):
+def place_entry(symbol: str, side: str, usd: float, leverage: int, impulse: bool, close_first: dict | None = None, ticker_future=None):
     """
     Вход + менеджер TP1/BE/trailing.
+    close_first: аргументы market-close старой позиции (reverse) —
+    тогда закрытие и вход уходят одним batch-запросом.
+    ticker_future: уже запущенный get_bid_ask (перекрыт с get_positions).
     """
-    set_leverage(symbol, leverage)
+    # Независимые preflight-вызовы идут параллельно
+    f_leverage = _executor.submit(set_leverage, symbol, leverage)
+    f_ticker = ticker_future if ticker_future is not None else _executor.submit(get_bid_ask, symbol)
+    f_filters = _executor.submit(get_instrument_filters, symbol)
+
+    f_leverage.result()
+    last, bid, ask = f_ticker.result()
+    qty_step, tick_size = f_filters.result()
 
-    last, bid, ask = get_bid_ask(symbol)
-    spread_pct = (ask - bid) / last * Decimal("100")
-    if spread_pct > Decimal(str(MAX_SPREAD_PCT)):
+    spread_pct = (ask - bid) / last * _D100
+    if spread_pct > _MAX_SPREAD_D:
         raise RuntimeError(f"Spread too high: {spread_pct:.4f}% > {MAX_SPREAD_PCT}%")
 
     price = last
-    qty_step, tick_size = get_instrument_filters(symbol)
 
-    qty = calc_qty_from_usd(symbol, usd, leverage, price)
+    qty = calc_qty_from_usd(usd, leverage, price, qty_step)
     if qty <= 0:
         raise RuntimeError("Bad qty computed")
 
-    r = session.place_order(
-        category="linear",
-        symbol=symbol,
-        side=side,
-        orderType="Market",
-        qty=str(qty),
-        timeInForce="IOC",
-        reduceOnly=False,
-    )
-    if r.get("retCode") != 0:
-        raise RuntimeError(f"Bybit place_order error: {r}")
+    plan = build_protection_plan(side, price, qty, tick_size, qty_step)
+
+    entry_args = {
+        "category": "linear",
+        "symbol": symbol,
+        "side": side,
+        "orderType": "Market",
+        "qty": str(qty),
+        "timeInForce": "IOC",
+        "reduceOnly": False,
+    }
+    # TP1 + early SL прямо в входном ордере: 1 RTT вместо 3 и нет окна,
+    # когда позиция уже открыта, а стопов ещё нет.
+    attach_args = {
+        "tpslMode": "Partial",
+        "takeProfit": str(plan["tp1_price"]),
+        "tpOrderType": "Limit",
+        "tpLimitPrice": str(plan["tp1_price"]),
+        "tpSize": str(plan["tp1_qty"]),
+        "tpTriggerBy": "LastPrice",
+        "stopLoss": str(plan["early_sl"]),
+        "slOrderType": "Market",
+        "slSize": str(qty),
+        "slTriggerBy": "LastPrice",
+    }
+
+    attached = True
+    r = None
+
+    if close_first is not None:
+        # Reverse: закрытие старой позиции + новый вход одним batch-запросом
+        batch_entry = {**entry_args, **attach_args}
+        batch_entry.pop("category")
+        try:
+            rb = session.place_batch_order(category="linear", request=[close_first, batch_entry])
+            if rb.get("retCode") != 0:
+                raise RuntimeError(f"Bybit place_batch_order error: {rb}")
+            rejected = [
+                it for it in ((rb.get("retExtInfo") or {}).get("list") or [])
+                if it.get("code") not in (0, None)
+            ]
+            if rejected:
+                raise RuntimeError(f"Bybit batch order rejected: {rejected}")
+            r = rb
+        except Exception as e:
+            logging.info("Batch close+open failed -> sequential fallback: %s", str(e))
+            rc = _place_order(category="linear", **close_first)
+            if rc.get("retCode") != 0:
+                raise RuntimeError(f"Bybit close position error: {rc}")
+
+    if r is None:
+        try:
+            r = _place_order(**entry_args, **attach_args)
+            if r.get("retCode") != 0:
+                raise RuntimeError(f"Bybit place_order (attached TP/SL) error: {r}")
+        except Exception as e:
+            # Не все символы принимают Partial TP/SL одним запросом -> старый путь
+            logging.info("TP/SL attach on entry failed -> fallback: %s", str(e))
+            attached = False
+            r = _place_order(**entry_args)
+            if r.get("retCode") != 0:
+                raise RuntimeError(f"Bybit place_order error: {r}")
 
-    mgr = manage_after_entry(symbol, side, price, qty, tick_size, qty_step, impulse)
+    mgr = manage_after_entry(symbol, side, price, qty, tick_size, qty_step, impulse, plan=plan, attached=attached)
 
     return {
         "symbol": symbol,
@@ -467,6 +1262,20 @@ def place_entry(symbol: str, side: str, usd: float, leverage: int, impulse: bool
     }
 
 
+# Хелсчеки Render долбят / и /health постоянно; отвечаем до роутинга
+# Flask заранее сериализованным телом — меньше GIL-возни в бурсты.
+_HEALTH_BODY = orjson.dumps({"ok": True, "testnet": BYBIT_TESTNET})
+
+
+@app.before_request
+def _fast_health():
+    if request.method == "GET":
+        if request.path == "/health":
+            return Response(_HEALTH_BODY, mimetype="application/json")
+        if request.path == "/":
+            return Response(b"OK", mimetype="text/plain")
+
+
 @app.get("/")
 def home():
     return "OK", 200
@@ -527,89 +1336,287 @@ def ready():
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
+def _prefetch_filters(symbol: str):
+    try:
+        get_instrument_filters(symbol)
+    except Exception as e:
+        logging.info("Filters prefetch failed: %s", str(e))
+
+
+def process_signal(job: dict):
+    """
+    Тело сигнала, выполняется в фоне (worker-тред).
+    TV уже получил 200 — здесь можно спокойно ходить в Bybit.
+    """
+    symbol = job["symbol"]
+    side = job["side"]
+    usd = job["usd"]
+    leverage = job["leverage"]
+    impulse = job["impulse"]
+
+    # Пока ждём get_positions, параллельно греем кэш фильтров и тикер —
+    # place_entry возьмёт их уже без RTT.
+    _executor.submit(_prefetch_filters, symbol)
+    f_ticker = _executor.submit(get_bid_ask, symbol)
+
+    # Позиция есть?
+    pos = get_position(symbol)
+    if pos:
+        pos_side = pos["side"]
+
+        # авто-reverse. Под пер-символьным локом: тик менеджера, успевший
+        # прочитать state старой позиции, дорабатывает до реверса, а
+        # следующий увидит уже state новой — иначе он воскресил бы старый
+        # st поверх записанного manage_after_entry.
+        if AUTO_REVERSE and side == _OPP_SIDE.get(pos_side):
+            logging.info("AUTO_REVERSE: closing %s and opening %s", pos_side, side)
+            with _symbol_lock(symbol):
+                cancel_all_orders(symbol)
+                with _state_lock:
+                    _position_state.pop(symbol, None)
+                _state_dirty.set()
+                close_args = _close_order_args(symbol, pos_side, abs(pos["size"]))
+                res = place_entry(symbol, side, usd, leverage, impulse, close_first=close_args, ticker_future=f_ticker)
+            logging.info("Reversed: closed old & opened new: %s", res)
+            return
+
+        # иначе просто пропускаем
+        logging.info("Position already open -> skip (%s %s size=%s)", symbol, pos_side, str(pos["size"]))
+        return
+
+    # НОВЫЙ ВХОД
+    with _symbol_lock(symbol):
+        res = place_entry(symbol, side, usd, leverage, impulse, ticker_future=f_ticker)
+    logging.info("Order placed (TP1+BE+ATR trailing manager): %s", res)
+
+
+def _signal_worker():
+    while True:
+        job = _signal_queue.get()
+        try:
+            process_signal(job)
+        except RuntimeError as e:
+            # Ожидаемые отказы (spread too high, retCode от Bybit) — одна
+            # строка, без прогулки по стеку ради трейсбека
+            logging.error("SIGNAL ERROR: %s", str(e))
+        except Exception:
+            logging.exception("SIGNAL ERROR")
+        finally:
+            _signal_queue.task_done()
+
+
+# Нормализация side без цепочки if/elif
+_SIDE_MAP = {"buy": "Buy", "long": "Buy", "sell": "Sell", "short": "Sell"}
+
+# Несколько воркеров: пачка алертов по разным символам (открытие рынка)
+# обрабатывается параллельно, а не по одному
+SIGNAL_WORKERS = int(os.getenv("SIGNAL_WORKERS", "2"))
+
+_signal_queue = queue.Queue(maxsize=256)
+
+
+def _queue_signal(item: dict, event_id: str):
+    """
+    Валидация одного сигнала и постановка в очередь.
+    Возвращает dict для ответа; "error"/"status" — если сигнал не принят.
+    """
+    symbol = str(item.get("symbol", DEFAULT_SYMBOL)).upper().strip()
+    if not symbol:
+        return {"error": "Missing symbol", "status": 400}
+
+    side_raw = str(item.get("side", "")).strip().lower()
+    side = _SIDE_MAP.get(side_raw)
+    if side is None:
+        return {"error": "Bad side. Use BUY/SELL", "status": 400, "got": side_raw}
+
+    # Одна компактная строка на сигнал вместо дампа всего payload
+    logging.info("Signal %s %s event=%s", symbol, side, event_id)
+
+    # Кривое число в payload — ошибка этого сигнала, а не 500 всего запроса
+    try:
+        usd = float(item.get("usd", DEFAULT_USD))
+        leverage = int(item.get("leverage", DEFAULT_LEVERAGE))
+    except (TypeError, ValueError):
+        return {"error": "Bad usd/leverage", "status": 400}
+
+    if usd <= 0:
+        return {"error": "usd must be > 0", "status": 400}
+    if leverage < 1 or leverage > 100:
+        return {"error": "leverage out of range", "status": 400}
+
+    # Дубликат того же сигнала в окне -> выходим до любых Bybit-вызовов.
+    # Валидация уже позади: ключ помечается только для сигнала, который
+    # реально дойдёт до очереди, и откатывается, если очередь полна —
+    # иначе ретрай после 503 съедался как "duplicate".
+    dedup_key = (symbol, side)
+    with _dedup_lock:
+        if dedup_key in _dedup_cache:
+            return {"skipped": True, "symbol": symbol, "side": side}
+        _dedup_cache[dedup_key] = True
+
+    job = {
+        "symbol": symbol,
+        "side": side,
+        "usd": usd,
+        "leverage": leverage,
+        "impulse": bool(item.get("impulse", False)),
+    }
+    try:
+        _signal_queue.put_nowait(job)
+    except queue.Full:
+        with _dedup_lock:
+            _dedup_cache.pop(dedup_key, None)
+        return {"error": "Signal queue full", "status": 503}
+
+    return {"symbol": symbol, "side": side, "queued": True}
+
+
 @app.post("/webhook")
 def webhook():
     try:
+        if not TV_WEBHOOK_SECRET:
+            return bad("Bad secret", 401)
+
+        # Секрет в заголовке проверяем ДО парсинга тела: мусорный трафик
+        # отбивается за O(1), не заставляя нас разбирать его JSON.
+        # Сравниваем байты: compare_digest на str кидает TypeError, если
+        # в подконтрольном атакующему заголовке есть не-ASCII — дешёвый
+        # 401 превращался бы в 500.
+        header_sig = request.headers.get("X-TV-Signature")
+        if header_sig is not None and not hmac.compare_digest(
+            header_sig.encode(), TV_WEBHOOK_SECRET.encode()
+        ):
+            return bad("Bad secret", 401)
+
         if not request.is_json:
             return bad("Expected application/json", 415, got_content_type=request.content_type)
 
         data = request.get_json(silent=True) or {}
-        logging.info("Webhook json: %s", data)
+        # Полный payload (включая secret) — только на DEBUG
+        logging.debug("Webhook json: %s", data)
+
+        # secret в теле (стандартный путь TV); compare_digest — без
+        # утечки длины совпавшего префикса по таймингу
+        if header_sig is None:
+            secret = str(data.get("secret", ""))
+            if not hmac.compare_digest(secret.encode(), TV_WEBHOOK_SECRET.encode()):
+                return bad("Bad secret", 401)
+
+        # Идемпотентность: повтор того же события (ретрай TV) не торгуем.
+        # event_id из payload, иначе — hash сырого тела.
+        event_id = str(data.get("event_id") or "")
+        if not event_id:
+            event_id = hashlib.blake2b(request.get_data(cache=True), digest_size=16).hexdigest()
+        # Здесь только проверка: ключ записывается после успешной
+        # постановки в очередь, чтобы 503/ошибка не съедала ретрай TV
+        with _seen_lock:
+            if event_id in _seen_events:
+                return Response(_DUP_RESP_BODY, mimetype="application/json")
+
+        # Слишком старое событие (застрявший ретрай) опаснее, чем пропуск
+        ev_ts = data.get("ts")
+        if ev_ts is not None:
+            try:
+                if _now() - int(float(ev_ts)) > MAX_EVENT_AGE_SEC:
+                    return ok("Stale event -> skip", skipped=True, event_age_limit=MAX_EVENT_AGE_SEC)
+            except (TypeError, ValueError):
+                pass
+
+        # Пакетный алерт: {"orders": [{symbol, side, ...}, ...]} — несколько
+        # символов одним вебхуком; элементы валидируются независимо,
+        # ошибка одного не роняет остальные.
+        orders = data.get("orders")
+        if orders is not None:
+            if not isinstance(orders, list) or not orders:
+                return bad("orders must be a non-empty list", 400)
+            results = []
+            for it in orders:
+                if not isinstance(it, dict):
+                    results.append({"error": "order item must be an object", "status": 400})
+                    continue
+                try:
+                    results.append(_queue_signal(it, event_id))
+                except Exception as e:
+                    # Один битый элемент не роняет остальные
+                    logging.exception("Batch item error")
+                    results.append({"error": "internal_error", "detail": str(e), "status": 500})
+            queued = sum(1 for r in results if r.get("queued"))
+            # Ключ идемпотентности сгорает только если не потерян ни один
+            # элемент (queued или dedup-skip): при частичном 503 ретрай TV
+            # должен пройти, а уже поставленные элементы на ретрае
+            # отфильтрует дедуп-окно (symbol, side).
+            if all("error" not in r for r in results):
+                with _seen_lock:
+                    _seen_events[event_id] = True
+            return ok("Batch queued", queued=queued, results=results)
+
+        # Вся работа с Bybit — в фоне. TV получает 200 за миллисекунды
+        # и не ретраит "медленный" webhook (ретраи = дубль-ордера).
+        res = _queue_signal(data, event_id)
+        if "error" in res:
+            status = res.pop("status", 400)
+            return bad(res.pop("error"), status, **res)
+        if res.get("skipped"):
+            return Response(_DUP_RESP_BODY, mimetype="application/json")
+
+        with _seen_lock:
+            _seen_events[event_id] = True
+        return ok("Signal queued", queued=True, symbol=res["symbol"], side=res["side"])
 
-        # secret
-        secret = str(data.get("secret", ""))
-        if (not TV_WEBHOOK_SECRET) or (secret != TV_WEBHOOK_SECRET):
-            return bad("Bad secret", 401)
+    except Exception as e:
+        logging.exception("WEBHOOK ERROR")
+        return jsonify({"ok": False, "error": "internal_error", "detail": str(e)}), 500
 
-        symbol = str(data.get("symbol", DEFAULT_SYMBOL)).upper().strip()
-        if not symbol:
-            return bad("Missing symbol", 400)
 
-        # обновляем менеджер позиции на каждом webhook
-        try:
-            update_position_manager(symbol)
-        except Exception as e:
-            logging.info("update_position_manager skipped: %s", str(e))
-
-        side_raw = str(data.get("side", "")).strip().lower()
-        if side_raw in ("buy", "long"):
-            side = "Buy"
-        elif side_raw in ("sell", "short"):
-            side = "Sell"
-        else:
-            return bad("Bad side. Use BUY/SELL", 400, got=side_raw)
-
-        usd = float(data.get("usd", DEFAULT_USD))
-        leverage = int(data.get("leverage", DEFAULT_LEVERAGE))
-        impulse = bool(data.get("impulse", False))
-
-        if usd <= 0:
-            return bad("usd must be > 0", 400)
-        if leverage < 1 or leverage > 100:
-            return bad("leverage out of range", 400)
-
-        # Если TV прислал конкретные параметры — используем их, иначе берём по стороне из ENV.
-        # (это ключ к “лонг как сейчас” + “шорт как раньше”)
-        if side == "Buy":
-            default_tp = LONG_TP_IMPULSE_PCT if impulse else LONG_TP_PCT
-            default_sl = LONG_SL_PCT
-        else:
-            default_tp = SHORT_TP_IMPULSE_PCT if impulse else SHORT_TP_PCT
-            default_sl = SHORT_SL_PCT
-
-        tp_pct = float(data.get("tp_pct", default_tp))
-        sl_pct = float(data.get("sl_pct", default_sl))
-
-        # Позиция есть?
-        pos = get_position(symbol)
-        if pos:
-            pos_side = pos["side"]
-
-            # авто-reverse
-            if AUTO_REVERSE and ((pos_side == "Buy" and side == "Sell") or (pos_side == "Sell" and side == "Buy")):
-                logging.info("AUTO_REVERSE: closing %s and opening %s", pos_side, side)
-                cancel_all_orders(symbol)
-                close_position_market(symbol, pos_side, abs(pos["size"]))
-                _position_state.pop(symbol, None)
-                res = place_entry(symbol, side, usd, leverage, impulse)
-                return ok("Reversed: closed old & opened new", **res)
+# Фоновые треды стартуют НЕ на импорте: при gunicorn preload_app импорт
+# происходит в мастере, и треды не переживают fork — воркеры остались бы
+# без signal-воркеров, менеджера и слушателя логов.
+_bg_started = False
+_bg_lock = threading.Lock()
 
-            # иначе просто пропускаем
-            return ok("Position already open -> skip", symbol=symbol, pos_side=pos_side, size=str(pos["size"]))
 
-        # НОВЫЙ ВХОД
-        res = place_entry(symbol, side, usd, leverage, impulse)
-        res["tp_pct_used_for_info"] = tp_pct
-        res["sl_pct_used_for_info"] = sl_pct
-        res["impulse"] = impulse
-        return ok("Order placed (TP1+BE+ATR trailing manager)", **res)
+def start_background_threads():
+    """
+    Поднимает все фоновые треды процесса (лог-листенер, signal-воркеры,
+    keep-alive, менеджер, sweep/flush, WS-стримы). Идемпотентна; зовётся
+    из post_fork-хука gunicorn_conf.py, из __main__ и лениво из
+    before_request — на случай запуска без нашего конфига.
+    """
+    global _bg_started, _log_listener
+    with _bg_lock:
+        if _bg_started:
+            return
+        _bg_started = True
 
-    except Exception as e:
-        logging.error("WEBHOOK ERROR: %s", str(e))
-        logging.error(traceback.format_exc())
-        return jsonify({"ok": False, "error": "internal_error", "detail": str(e)}), 500
+    # Листенер времён импорта живёт в мастере и не переживает fork —
+    # поднимаем свежий; в не-fork сценарии второй листенер на той же
+    # очереди безвреден (каждая запись уходит ровно одному).
+    _log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+    _log_listener.start()
+
+    threading.Thread(target=_keepalive_loop, daemon=True, name="keepalive-ping").start()
+    threading.Thread(target=_sweep_states, daemon=True, name="state-sweep").start()
+    threading.Thread(target=_manager_loop, daemon=True, name="position-manager").start()
+    threading.Thread(target=_flush_states, daemon=True, name="state-flush").start()
+    for i in range(SIGNAL_WORKERS):
+        threading.Thread(target=_signal_worker, daemon=True, name=f"signal-worker-{i}").start()
+
+    if USE_WS_STREAMS:
+        _start_ws_streams()
+
+
+@app.before_request
+def _ensure_background():
+    if not _bg_started:
+        start_background_threads()
+
+
+_load_states()
+_prewarm_instruments()
 
 
 if __name__ == "__main__":
+    # Только для локальной отладки; в проде: gunicorn -c gunicorn_conf.py main:app
+    start_background_threads()
     port = int(os.getenv("PORT", "5000"))
     app.run(host="0.0.0.0", port=port)